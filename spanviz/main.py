@@ -1,12 +1,20 @@
 
 import argparse
 import sys
-import json
 import logging
 import math
 import tempfile
 import webbrowser
 import itertools
+import collections
+import bisect
+import functools
+import multiprocessing
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 
 colors = {  # matplotlib's tab10 palette
@@ -22,27 +30,43 @@ colors = {  # matplotlib's tab10 palette
     'cyan': '#17becf',
 }
 
+_PALETTE = tuple(colors.values())
+
 
 def main():
 
     argparser = argparse.ArgumentParser(description='Rendering a text with highlighted spans as html.')
-    argparser.add_argument('jsonl', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help="jsonl file with text and spans to render (default: stdin)")
+    argparser.add_argument('jsonl', nargs='?', type=argparse.FileType('rb'), default=sys.stdin.buffer, help="jsonl file with text and spans to render (default: stdin)")
     argparser.add_argument('--text', nargs='?', type=str, help="which key in each json record contains the text", default='text')
     argparser.add_argument('--spans', nargs='?', type=str, help="which key contains the spans, in start,end,label format", default='spans')
     argparser.add_argument('--serve', required=False, action='store_true', help="whether to serve the html in a browser")
     argparser.add_argument('--rainbow', required=False, action='store_true', help="to alternate colors in overlapping spans, as opposed to blending colors")
+    argparser.add_argument('-j', '--jobs', required=False, type=int, help="number of processes to render records with (default: 1)", default=1)
 
 
     args = argparser.parse_args()
 
-    outfile = sys.stdout if not args.serve else tempfile.NamedTemporaryFile('w', delete=False, suffix='.html')
+    if args.jobs < 1:
+        argparser.error('--jobs must be at least 1')
 
-    for line in args.jsonl:
-        d = json.loads(line)
+    outfile = sys.stdout.buffer if not args.serve else tempfile.NamedTemporaryFile('wb', delete=False, suffix='.html')
 
-        html = spans_to_html(d[args.text], d[args.spans], rainbow=args.rainbow)
+    colormap = {}
 
-        print(f"<p>{html}</p>", file=outfile)
+    if args.jobs <= 1:
+        # Identical lines render identically (their labels already have colors), so recent ones are cached.
+        @functools.lru_cache(maxsize=1024)
+        def render_line(line: bytes) -> str:
+            d = loads(line)
+            return spans_to_html(d[args.text], d[args.spans], colormap=colormap, rainbow=args.rainbow)
+
+        _write_paragraphs(map(render_line, args.jsonl), outfile)
+    else:
+        records = (loads(line) for line in args.jsonl)
+        # Colors are assigned here, in input order, so they are the same as with a single process.
+        tasks = ((d[args.text], d[args.spans], _assign_colors(colormap, d[args.spans]), args.rainbow) for d in records)
+        with multiprocessing.Pool(args.jobs) as pool:
+            _write_paragraphs(pool.imap(_render_record, tasks, chunksize=256), outfile)
 
     if args.serve:
         url = 'file://' + outfile.name
@@ -50,86 +74,169 @@ def main():
         webbrowser.open(url)
 
 
-def update_colormap(colormap: dict, spans: list[dict]):
-    for lab in sorted(set(span['label'] for span in spans)):
+def _write_paragraphs(htmls, outfile):
+    out_chunks = []
+
+    for html in htmls:
+        out_chunks.append(f"<p>{html}</p>\n")
+        if len(out_chunks) >= 1024:
+            outfile.write(''.join(out_chunks).encode('utf-8'))
+            out_chunks.clear()
+
+    outfile.write(''.join(out_chunks).encode('utf-8'))
+
+
+def _assign_colors(colormap: dict, spans: list[dict]) -> dict:
+    spans = list(standardize_spans(spans))
+    update_colormap(colormap, spans)
+    return {label: colormap[label] for _, _, label in spans}
+
+
+def _render_record(task: tuple) -> str:
+    text, spans, colormap, rainbow = task
+    return spans_to_html(text, spans, colormap=colormap, rainbow=rainbow)
+
+
+def update_colormap(colormap: dict, spans: list[tuple[int, int, str]]):
+    for lab in sorted(set(label for _, _, label in spans)):
         if not lab in colormap:
-            colormap[lab] = list(colors.values())[len(colormap) % len(colors)]
-        if len(colormap) > len(colors):
+            colormap[lab] = _PALETTE[len(colormap) % len(_PALETTE)]
+        if len(colormap) > len(_PALETTE):
             logging.debug('Not enough colors available.')
 
 
-def spans_to_html(text: str, spans: list[dict], rainbow=False):
-    return render_spans(text=text, spans=spans, rainbow=rainbow)
+def spans_to_html(text: str, spans: list[dict], colormap: dict = None, rainbow=False):
+    return render_spans(text=text, spans=spans, colormap=colormap, rainbow=rainbow)
 
 
 def spans_to_md(text: str, spans: list[dict], with_labels=True):
-    return render_spans(text=text, spans=spans, colormap={}, with_labels=with_labels, to_markdown=True)
+    return render_spans(text=text, spans=spans, with_labels=with_labels, to_markdown=True)
+
 
+def render_spans(text: str, spans: list[dict], colormap: dict = None, rainbow=False, to_markdown=False, with_labels=True):
 
-def render_spans(text: str, spans: list[dict], colormap={}, rainbow=False, to_markdown=False, with_labels=True):
+    if not spans:
+        return text
 
+    colormap = {} if colormap is None else colormap
     spans = list(standardize_spans(spans))
 
     update_colormap(colormap, spans)
 
-    starts_and_ends = {0, len(text)}
-    for span in spans:
-        starts_and_ends.add(span['start'])
-        starts_and_ends.add(span['end'])
+    segments = list(segment_spans(spans, len(text)))
 
-    starts_and_ends = sorted(starts_and_ends)
+    marks = {}
+    for _, _, labels_for_span in segments:
+        if labels_for_span and labels_for_span not in marks:
+            colors_for_span = tuple(colormap[label] for label in labels_for_span)
+            hovertext = ','.join(labels_for_span)
+            marks[labels_for_span] = _mark_prefix(hovertext, colors_for_span, rainbow=rainbow, to_markdown=to_markdown, with_labels=with_labels)
 
-    snippets = []
+    render_fn = _render_md if to_markdown else (_render_html_rainbow if rainbow else _render_html_blend)
+    return render_fn(text, segments, marks)
 
-    for start, end in zip(starts_and_ends, starts_and_ends[1:]):
-        labels_for_span = set(span['label'] for span in spans if span['start'] <= start and span['end'] >= end)
 
-        if not labels_for_span:
+def _render_html_blend(text: str, segments: list[tuple], marks: dict) -> str:
+    snippets = []
+    for start, end, labels_for_span in segments:
+        if labels_for_span:
+            snippets.append(f'{marks[labels_for_span]}{text[start:end]}</mark>')
+        else:
             snippets.append(text[start:end])
-            continue
+    return ''.join(snippets)
 
-        colors_for_span = [colormap[label] for label in labels_for_span]
-        hovertext = ','.join(labels_for_span)
 
-        if to_markdown:
-            label_str = '_' + hovertext if with_labels else ''
-            snippets.append(f'\****{text[start:end]}{label_str}***\*')
+def _render_html_rainbow(text: str, segments: list[tuple], marks: dict) -> str:
+    snippets = []
+    for start, end, labels_for_span in segments:
+        if labels_for_span:
+            rainbow_chars = [f'{mark_for_char}{c}</mark>' for c, mark_for_char in zip(text[start:end], itertools.cycle(marks[labels_for_span]))]
+            snippets.append(''.join(rainbow_chars))
         else:
-            tooltip = f' title="{hovertext}"' if with_labels else ''
-            if not rainbow:
-                blended_color = colorblend(*colors_for_span)
-                snippets.append(f'<mark style="background-color:{blended_color}66"{tooltip};>{text[start:end]}</mark>')
-            else:
-                rainbow_chars = [f'<mark style="background-color:{color}66"{tooltip}";>{c}</mark>' for c, color in zip(text[start:end],
-                                                                                                                 itertools.cycle(colors_for_span))]
-                snippets.append(''.join(rainbow_chars))
+            snippets.append(text[start:end])
+    return ''.join(snippets)
 
 
+def _render_md(text: str, segments: list[tuple], marks: dict) -> str:
+    snippets = []
+    for start, end, labels_for_span in segments:
+        if labels_for_span:
+            snippets.append(f'\\****{text[start:end]}{marks[labels_for_span]}***\\*')
+        else:
+            snippets.append(text[start:end])
     return ''.join(snippets)
 
 
+@functools.lru_cache(maxsize=None)
+def _mark_prefix(hovertext: str, colors_for_span: tuple[str], rainbow=False, to_markdown=False, with_labels=True):
+    # Markup preceding a highlighted snippet; for markdown, the label suffix instead; for rainbow, one per color.
+    if to_markdown:
+        return '_' + hovertext if with_labels else ''
+
+    tooltip = f' title="{hovertext}"' if with_labels else ''
+    if not rainbow:
+        blended_color = colorblend(*colors_for_span)
+        return f'<mark style="background-color:{blended_color}66"{tooltip};>'
+    else:
+        return tuple(f'<mark style="background-color:{color}66"{tooltip}";>' for color in colors_for_span)
+
+
+def segment_spans(spans: list[tuple[int, int, str]], length: int):
+    # Sweep-line over all span boundaries, yielding (start, end, labels) for each segment between
+    # consecutive boundaries, with labels a tuple of the labels of the spans covering that segment,
+    # in the order in which they became active.
+    # Spans are pre-sorted by start and by end, so each boundary only needs two binary searches.
+    boundaries = sorted({0, length, *(start for start, _, _ in spans), *(end for _, end, _ in spans)})
+
+    # Empty (or reversed) spans cover nothing, so only their boundaries (above) are kept.
+    spans = [span for span in spans if span[0] < span[1]]
+
+    # Parallel arrays of positions and labels, sorted by start and by end respectively.
+    starts_sorted, _, start_labels = zip(*sorted(spans, key=lambda span: span[0])) if spans else ((), (), ())
+    _, ends_sorted, end_labels = zip(*sorted(spans, key=lambda span: span[1])) if spans else ((), (), ())
+
+    active = collections.Counter()
+    n_started = 0
+    n_ended = 0
+
+    for start, end in zip(boundaries, boundaries[1:]):
+        # Covering spans are those started at or before start, minus those already ended by then.
+        started = bisect.bisect_right(starts_sorted, start)
+        ended = bisect.bisect_right(ends_sorted, start)
+        for label in start_labels[n_started:started]:
+            active[label] += 1
+        for label in end_labels[n_ended:ended]:
+            active[label] -= 1
+            if not active[label]:
+                del active[label]
+        n_started = started
+        n_ended = ended
+        yield start, end, tuple(active)
+
+
 def standardize_spans(spans):
     # TODO Refactor; and do proper input validation
     # spans can be {start:, end:, label/tag:} or [1,2,label]
     # if args.multi: {subspans: [{start:, end:,}, {start: end:}], label/tag:}  or [[1,2],[3,4],label]
+    # yields (start, end, label) tuples
 
     for n, span in enumerate(spans):
         if 'start' in span:
-            span['label'] = str(span.get('label', n))
-            yield span
+            yield int(span['start']), int(span['end']), str(span.get('label', n))
         else:
             if isinstance(span, dict):
                 label = str(span.get('label', n))
                 for subspan in span['subspans']:
-                    yield {'label': str(subspan.get('label', label)), **subspan}
+                    yield int(subspan['start']), int(subspan['end']), str(subspan.get('label', label))
             else:
                 for subspan in span:
-                    yield {'label': str(subspan.get('label', n)), **subspan}
+                    yield int(subspan['start']), int(subspan['end']), str(subspan.get('label', n))
 
 
 
 # Color blender adapted from https://github.com/ChristianChiarulli/colorblender/blob/master/colorblender.py
 
+@functools.lru_cache(maxsize=None)
 def hex_to_rgb(hex: str) -> tuple[int, int, int]:
     clean_hex: str = hex.replace("#", "")
     return tuple(int(clean_hex[i : i + 2], 16) for i in (0, 2, 4))
@@ -138,18 +245,21 @@ def hex_to_rgb(hex: str) -> tuple[int, int, int]:
 def colorblend(*hexcolors: tuple[str], alphas: list[float] = None) -> str:
 
     rgb_colors = [hex_to_rgb(hex) for hex in hexcolors]
-    alphas = alphas or [1 / len(rgb_colors) for _ in rgb_colors]
 
-    def blend_channel(channel: int) -> int:
-        blended_channel: float = sum(alpha * rgb[channel] for alpha, rgb in zip(alphas, rgb_colors))
-        return math.floor(min(max(0, blended_channel), 255) + 0.5)
+    if not rgb_colors:
+        return '#000000'
+
+    # Uniform blend: mean of each channel in integer arithmetic, with exact .5 ties rounded up
+    # (float weights 1/k could round some of those down).
+    if not alphas:
+        k = len(rgb_colors)
+        return "#%02x%02x%02x" % tuple((2 * sum(channel_values) + k) // (2 * k) for channel_values in zip(*rgb_colors))
 
-    def rgb_to_hex(rgb: tuple[int, int, int]) -> str:
-        return "#" + "".join(
-            ["0{0:x}".format(v) if v < 16 else "{0:x}".format(v) for v in rgb]
-        )
+    def blend_channel(channel_values: tuple[int, ...]) -> int:
+        blended_channel: float = sum(alpha * value for alpha, value in zip(alphas, channel_values))
+        return math.floor(min(max(0, blended_channel), 255) + 0.5)
 
-    return rgb_to_hex((blend_channel(0), blend_channel(1), blend_channel(2)))
+    return "#%02x%02x%02x" % tuple(blend_channel(channel_values) for channel_values in zip(*rgb_colors))
 
 
 if __name__ == '__main__':